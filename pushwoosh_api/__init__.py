@@ -1,3 +1,9 @@
 from .pushwoosh_exceptions import *
 from .pushwoosh import *
-from .integration import *
\ No newline at end of file
+from .integration import *
+from .segmentation import *
+from .resilience import *
+from .stats import *
+from .tracking import *
+from .ratelimit import *
+from .transport import *
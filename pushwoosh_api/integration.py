@@ -21,8 +21,15 @@ class IntegrationAPI:
     _last_request_error = None
     _last_request_text = None
 
-    def __init__(self, api_key, api_endpoint=None):
+    def __init__(self, api_key, api_endpoint=None, transport=None):
+        """
+        :param api_key: Integrations API key
+        :param api_endpoint: (optional) API URL
+        :param transport: (optional) object with requests-like post() method, e.g. RecordingTransport or
+                          ReplayTransport. Default: requests
+        """
         self.api_key = api_key
+        self.transport = transport
         self.headers["Authorization"] = api_key
         if not api_endpoint:
             self.api_endpoint = "https://integrations.pushwoosh.com/api/v1"
@@ -38,7 +45,8 @@ class IntegrationAPI:
         logger.debug("Url: {}".format(url))
         logger.debug("Data JSON: {}".format(json.dumps(request)))
 
-        response = requests.post(url, data=json.dumps(request), headers=self.headers)
+        transport = self.transport if self.transport is not None else requests
+        response = transport.post(url, data=json.dumps(request), headers=self.headers)
         self._last_request_response = response
         logger.debug("Response code: {}".format(response.status_code))
         logger.debug("Response content: {}".format(response.content))
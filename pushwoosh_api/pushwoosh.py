@@ -1,13 +1,16 @@
 import requests
 import logging
 import json
+import re
 import time
 
-from tenacity import retry
+from tenacity import retry, retry_if_not_exception_type
 from .pushwoosh_exceptions import *
+from .tracking import iter_json_array, CHUNK_SIZE
 from json.decoder import JSONDecodeError
 
 OK_STATUSES = [200, 210]
+STATUS_CODE_RE = re.compile(r'"status_code"\s*:\s*(\d+)')
 WAIT_TIME = 5.0
 
 logger = logging.getLogger(__name__)
@@ -23,17 +26,40 @@ class Pushwoosh:
     _last_request_error = None
     _last_request_text = None
 
-    def __init__(self, api_endpoint, api_key=None):
+    def __init__(self, api_endpoint, api_key=None, resilience=None, rate_limiter=None, transport=None):
+        """
+        :param api_endpoint: API URL, e.g. "https://cp.pushwoosh.com/json/1.3"
+        :param api_key: API access token
+        :param resilience: (optional) Resilience instance enabling circuit breakers and hedged requests
+        :param rate_limiter: (optional) RateLimiter instance limiting request rates per endpoint
+        :param transport: (optional) object with requests-like post() method, e.g. RecordingTransport or
+                          ReplayTransport. Default: requests
+        """
         self.api_key = api_key
         self.api_endpoint = api_endpoint
+        self.resilience = resilience
+        self.rate_limiter = rate_limiter
+        self.transport = transport
 
-    @retry
-    def _send_request(self, uri, request):
-        # noinspection SpellCheckingInspection
+    def _post(self, uri, url, data, **kwargs):
         """
+        Sends a single HTTP request, waiting for the rate limiter if it is set
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(uri)
+        transport = self.transport if self.transport is not None else requests
+        response = transport.post(url, data=data, **kwargs)
+        if self.rate_limiter is not None:
+            self.rate_limiter.record(uri, response.status_code)
+        return response
+
+    def _request(self, uri, request, stream=False):
+        """
+        Builds the request envelope, sends it and checks the HTTP status
         :param uri: relative URI of the request, e.g. "getPushHistory"
-        :param request: object with request body as dict, e.g. { "app_code": "AAAAA-BBBBB"}
-        :return: dict with JSON response, e.g. {"status_code":200, "status": "OK", "response": {...}}
+        :param request: object with request body as dict
+        :param stream: do not read the response body, use response.iter_content() to consume it
+        :return: response object
         """
         r = {
             "request": request
@@ -46,35 +72,50 @@ class Pushwoosh:
         url = "{}/{}".format(self.api_endpoint, uri)
         self._last_request_url = url
 
+        data = json.dumps(r)
         logger.debug("Url: {}".format(url))
-        logger.debug("Data JSON: {}".format(json.dumps(r)))
+        logger.debug("Data JSON: {}".format(data))
 
-        response = requests.post(url, data=json.dumps(r))
+        kwargs = {"stream": True} if stream else {}
+        if self.resilience is not None:
+            response = self.resilience.call(uri, lambda: self._post(uri, url, data, **kwargs), hedge=not stream)
+        else:
+            response = self._post(uri, url, data, **kwargs)
         self._last_request_response = response
         logger.debug("Response code: {}".format(response.status_code))
-        logger.debug("Response content: {}".format(response.content))
 
-        if response.status_code in OK_STATUSES:
-            try:
-                json_result = response.json()
-                if json_result is not None:
-                    self._last_request_json = json_result
-                    logger.debug("Response json: {}".format(response.json()))
-                    return json_result
-            except JSONDecodeError:
-                self._last_request_text = response.text
-                logger.debug("Response text: {}".format(response.text))
-                logger.warning("No JSON in response from Pushwoosh API. Content: {}".format(response.content))
-                raise (EmptyJsonResponse(response,
-                                         "No JSON in Response from Pushwoosh. Response text: {}".format(response.text)))
-
-        else:
+        if response.status_code not in OK_STATUSES:
             logger.error("Error in response from Pushwoosh. Code: {} Reason: {}".format(response.status_code,
                                                                                         response.reason))
             logger.error("Headers from response: {}".format(response.headers))
             raise (HttpError(response.status_code, response.text,
                              "Pushwoosh API returned code {}. Reason: {}".format(response.status_code,
                                                                                  response.reason)))
+        return response
+
+    @retry(retry=retry_if_not_exception_type((CircuitOpenError, CassetteError)))
+    def _send_request(self, uri, request):
+        # noinspection SpellCheckingInspection
+        """
+        :param uri: relative URI of the request, e.g. "getPushHistory"
+        :param request: object with request body as dict, e.g. { "app_code": "AAAAA-BBBBB"}
+        :return: dict with JSON response, e.g. {"status_code":200, "status": "OK", "response": {...}}
+        """
+        response = self._request(uri, request)
+        logger.debug("Response content: {}".format(response.content))
+
+        try:
+            json_result = response.json()
+            if json_result is not None:
+                self._last_request_json = json_result
+                logger.debug("Response json: {}".format(json_result))
+                return json_result
+        except JSONDecodeError:
+            self._last_request_text = response.text
+            logger.debug("Response text: {}".format(response.text))
+            logger.warning("No JSON in response from Pushwoosh API. Content: {}".format(response.content))
+            raise (EmptyJsonResponse(response,
+                                     "No JSON in Response from Pushwoosh. Response text: {}".format(response.text)))
 
     def get_push_history(self, source=None, search_by=None, value=None, last_notification_id=0):
         """
@@ -269,13 +310,94 @@ class Pushwoosh:
         request = {
             "devices_filter": devices_filter
         }
+        return self._schedule(uri=uri, request=request)
 
+    def _schedule(self, uri, request):
         result = self._send_request(uri=uri, request=request)
         if result.get("response") is not None:
             return result.get("response").get("request_id")
         else:
             return result
 
+    def get_msg_stats(self, message):
+        """
+        Schedule calculation of message statistics, results are obtained through get_results()
+        https://docs.pushwoosh.com/platform-docs/api-reference/statistics#getmsgstats
+        :param message: message code
+        :return: request_id of the scheduled job or response object in case of error
+        """
+        uri = "getMsgStats"
+        request = {
+            "message": message
+        }
+        return self._schedule(uri=uri, request=request)
+
+    def get_msg_platforms_stats(self, message):
+        """
+        Schedule calculation of message statistics per platform, results are obtained through get_results()
+        https://docs.pushwoosh.com/platform-docs/api-reference/statistics#getmsgplatformsstats
+        :param message: message code
+        :return: request_id of the scheduled job or response object in case of error
+        """
+        uri = "getMsgPlatformsStats"
+        request = {
+            "message": message
+        }
+        return self._schedule(uri=uri, request=request)
+
+    def get_app_stats(self, application, datetime_from, datetime_to):
+        """
+        Schedule calculation of application statistics, results are obtained through get_results()
+        https://docs.pushwoosh.com/platform-docs/api-reference/statistics#getappstats
+        :param application: application code (AAAAA-BBBBB)
+        :param datetime_from: start of the period, "Y-m-d H:i:s"
+        :param datetime_to: end of the period, "Y-m-d H:i:s"
+        :return: request_id of the scheduled job or response object in case of error
+        """
+        uri = "getAppStats"
+        request = {
+            "application": application,
+            "datetime_from": datetime_from,
+            "datetime_to": datetime_to
+        }
+        return self._schedule(uri=uri, request=request)
+
+    def get_campaign_stats(self, campaign, datetime_from, datetime_to):
+        """
+        Schedule calculation of campaign statistics, results are obtained through get_results()
+        https://docs.pushwoosh.com/platform-docs/api-reference/statistics#getcampaignstats
+        :param campaign: campaign code
+        :param datetime_from: start of the period, "Y-m-d H:i:s"
+        :param datetime_to: end of the period, "Y-m-d H:i:s"
+        :return: request_id of the scheduled job or response object in case of error
+        """
+        uri = "getCampaignStats"
+        request = {
+            "campaign": campaign,
+            "datetime_from": datetime_from,
+            "datetime_to": datetime_to
+        }
+        return self._schedule(uri=uri, request=request)
+
+    def get_event_statistics(self, application, event, date_from, date_to):
+        """
+        Schedule calculation of event statistics, results are obtained through get_results()
+        https://docs.pushwoosh.com/platform-docs/api-reference/statistics#geteventstatistics
+        :param application: application code (AAAAA-BBBBB)
+        :param event: event name
+        :param date_from: start of the period, "Y-m-d H:i:s"
+        :param date_to: end of the period, "Y-m-d H:i:s"
+        :return: request_id of the scheduled job or response object in case of error
+        """
+        uri = "getEventStatistics"
+        request = {
+            "application": application,
+            "event": event,
+            "date_from": date_from,
+            "date_to": date_to
+        }
+        return self._schedule(uri=uri, request=request)
+
     def get_inbox_messages(self, application, user_id, hwid, last_code=None, count=0):
         """
         https://docs.pushwoosh.com/platform-docs/api-reference/message-inbox#getinboxmessages
@@ -374,6 +496,35 @@ class Pushwoosh:
         }
         return self._send_request(uri=uri, request=request)
 
+    def tracking_log_generator(self, date):
+        """
+        Same as get_tracking_log, but the response is parsed incrementally and events are yielded one by one:
+        for event in Pushwoosh.tracking_log_generator("2021-01-01"):
+        Events are the first array inside the "response" member of the envelope. The envelope status_code is checked
+        whether it comes before or after the events, so an error may be raised after some events were yielded.
+        :param date: date of the log
+        :return: generator of event objects
+        :raises HttpError: if the HTTP status or the envelope status_code is not OK
+        """
+        uri = "getTrackingLog"
+        request = {
+            "date": date
+        }
+        def check_status(envelope):
+            match = STATUS_CODE_RE.search(envelope)
+            if match is not None and int(match.group(1)) != 200:
+                raise (HttpError(int(match.group(1)), envelope,
+                                 "Pushwoosh API returned status_code {}: {}".format(match.group(1),
+                                                                                   envelope[:200])))
+
+        response = self._request(uri=uri, request=request, stream=True)
+        try:
+            for event in iter_json_array(response.iter_content(chunk_size=CHUNK_SIZE), key="response",
+                                         on_prefix=check_status, on_suffix=check_status):
+                yield event
+        finally:
+            response.close()
+
     def list_filters(self):
         uri = "listFilters"
         request = {}
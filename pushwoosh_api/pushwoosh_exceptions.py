@@ -28,4 +28,30 @@ class RequiredParametersError(PushwooshException):
     """
     def __init__(self, values, message):
         self.values = values
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+class FilterSyntaxError(PushwooshException):
+    """
+    Exception raised when a devices_filter expression cannot be parsed
+    """
+    def __init__(self, expression, position, message):
+        self.expression = expression
+        self.position = position
+        self.message = message
+
+class CircuitOpenError(PushwooshException):
+    """
+    Exception raised when the circuit breaker for an endpoint is open and the request is not sent
+    """
+    def __init__(self, uri, message):
+        self.uri = uri
+        self.message = message
+
+class CassetteError(PushwooshException):
+    """
+    Exception raised when a replayed request has no recorded response in the cassette
+    """
+    def __init__(self, url, data, message):
+        self.url = url
+        self.data = data
+        self.message = message
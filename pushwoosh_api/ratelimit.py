@@ -0,0 +1,236 @@
+import logging
+import os
+import struct
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+"""
+Client-side rate limiting for Pushwoosh._send_request: a token bucket per endpoint, optionally shared between
+processes on the same host through files locked with flock(). Rates adapt to throttling: on 429/5xx responses the
+rate is cut multiplicatively, every successful response increases it additively up to the configured maximum (AIMD).
+"""
+
+__all__ = ["TokenBucket", "FileTokenBucket", "RateLimiter"]
+
+_STATE = struct.Struct("dddd")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens.
+    State is a list [tokens, updated_at, rate, decreased_at].
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: maximum rate, requests per second
+        :param capacity: (optional) burst size, by default one second worth of requests
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive, got {}".format(rate))
+        self.max_rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        if self.capacity < 1:
+            raise ValueError("Capacity must be at least 1 token, got {}".format(capacity))
+        self._lock = threading.Lock()
+        self._state = [self.capacity, time.time(), self.max_rate, 0.0]
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            yield self._state
+
+    def _refill(self, state, now):
+        tokens, updated_at, rate = state[0], state[1], state[2]
+        state[0] = min(self.capacity, tokens + max(0.0, now - updated_at) * rate)
+        state[1] = now
+
+    @property
+    def rate(self):
+        with self._locked() as state:
+            return state[2]
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until the requested number of tokens is available and takes them
+        :param tokens: number of tokens
+        :return: total seconds spent waiting
+        """
+        if tokens > self.capacity:
+            raise ValueError("Cannot acquire {} tokens from a bucket of capacity {}".format(tokens, self.capacity))
+        waited = 0.0
+        while True:
+            with self._locked() as state:
+                self._refill(state, time.time())
+                if state[0] >= tokens:
+                    state[0] -= tokens
+                    return waited
+                wait = (tokens - state[0]) / state[2]
+            time.sleep(wait)
+            waited += wait
+
+    def decrease(self, factor, min_rate, cooldown):
+        """
+        Multiplies the rate by factor, at most once per cooldown seconds
+        :return: new rate or None if the rate was decreased less than cooldown seconds ago
+        """
+        with self._locked() as state:
+            now = time.time()
+            if now - state[3] < cooldown:
+                return None
+            self._refill(state, now)
+            state[2] = max(min_rate, state[2] * factor)
+            state[3] = now
+            return state[2]
+
+    def increase(self, step):
+        """
+        Adds step to the rate, up to max_rate
+        :return: new rate
+        """
+        with self._locked() as state:
+            if state[2] < self.max_rate:
+                self._refill(state, time.time())
+                state[2] = min(self.max_rate, state[2] + step)
+            return state[2]
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket which state is kept in a file and guarded by flock(), so all processes using the same file
+    share one budget and one adapted rate. Available on POSIX systems only.
+    The file is reopened in forked child processes: flock() locks belong to the open file, so a descriptor inherited
+    from the parent would not exclude the parent.
+    """
+
+    def __init__(self, path, rate, capacity=None):
+        """
+        :param path: path to the state file, created if missing
+        :param rate: maximum rate, requests per second
+        :param capacity: (optional) burst size, by default one second worth of requests
+        """
+        if fcntl is None:
+            raise RuntimeError("FileTokenBucket requires fcntl, which is not available on this platform")
+        super().__init__(rate, capacity)
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _file(self):
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fd = self._file()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(fd, _STATE.size, 0)
+                state = list(_STATE.unpack(data)) if len(data) == _STATE.size else \
+                    [self.capacity, time.time(), self.max_rate, 0.0]
+                yield state
+                os.pwrite(fd, _STATE.pack(*state), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+            self._pid = None
+
+
+class RateLimiter:
+    """
+    Pass an instance to Pushwoosh(..., rate_limiter=RateLimiter(...)) to limit request rates per endpoint:
+
+    limiter = RateLimiter(rates={"createMessage": 5, "setTags": 50, "getResults": 10}, default_rate=20,
+                          directory="/tmp/pushwoosh_buckets")
+
+    With directory set, every process using the same directory shares the buckets. Endpoints that are neither in
+    rates nor covered by default_rate are not limited.
+    """
+
+    def __init__(self, rates=None, default_rate=None, burst=None, directory=None, decrease_factor=0.5,
+                 increase_step=0.1, min_rate=0.1, cooldown=1.0):
+        """
+        :param rates: dict of URI -> maximum requests per second
+        :param default_rate: (optional) maximum requests per second for other URIs
+        :param burst: (optional) dict of URI -> bucket capacity
+        :param directory: (optional) directory with bucket files shared between processes
+        :param decrease_factor: rate multiplier applied on 429/5xx responses
+        :param increase_step: requests per second added to the rate on every successful response
+        :param min_rate: the rate is never decreased below this value
+        :param cooldown: minimal interval in seconds between two decreases of the same bucket
+        """
+        if min_rate <= 0:
+            raise ValueError("min_rate must be positive, got {}".format(min_rate))
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.burst = burst or {}
+        self.directory = directory
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.min_rate = min_rate
+        self.cooldown = cooldown
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def bucket(self, uri):
+        """
+        :param uri: relative URI, e.g. "createMessage"
+        :return: token bucket for the endpoint or None if it is not limited
+        """
+        with self._lock:
+            if uri in self._buckets:
+                return self._buckets[uri]
+            rate = self.rates.get(uri, self.default_rate)
+            bucket = None
+            if rate is not None:
+                if self.directory is not None:
+                    bucket = FileTokenBucket(os.path.join(self.directory, "{}.bucket".format(uri)), rate,
+                                             self.burst.get(uri))
+                else:
+                    bucket = TokenBucket(rate, self.burst.get(uri))
+            self._buckets[uri] = bucket
+            return bucket
+
+    def acquire(self, uri):
+        """
+        Blocks until a request to the endpoint may be sent
+        """
+        bucket = self.bucket(uri)
+        if bucket is not None:
+            waited = bucket.acquire()
+            if waited:
+                logger.debug("Rate limit for {}: waited {:.3f}s".format(uri, waited))
+
+    def record(self, uri, status_code):
+        """
+        Adapts the endpoint rate to the response status
+        """
+        bucket = self.bucket(uri)
+        if bucket is None:
+            return
+        if status_code == 429 or status_code >= 500:
+            rate = bucket.decrease(self.decrease_factor, self.min_rate, self.cooldown)
+            if rate is not None:
+                logger.warning("Got {} from {}, rate decreased to {:.2f} rps".format(status_code, uri, rate))
+        else:
+            bucket.increase(self.increase_step)
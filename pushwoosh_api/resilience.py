@@ -0,0 +1,341 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .pushwoosh_exceptions import *
+
+logger = logging.getLogger(__name__)
+"""
+Opt-in resilience layer for Pushwoosh._send_request:
+ * per-endpoint circuit breakers, failing fast while Pushwoosh is degraded;
+ * hedged requests for idempotent endpoints: if the first attempt is slower than the observed latency percentile,
+   a second one is fired and the first response wins.
+"""
+
+__all__ = ["IDEMPOTENT_URIS", "CircuitBreaker", "Resilience"]
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+IDEMPOTENT_URIS = [
+    "getResults",
+    "getPreset",
+    "listPresets",
+    "getInboxMessages",
+    "getPushHistory",
+    "getApplications",
+    "getCampaigns",
+    "listFilters",
+    "listTags",
+    "getMessageLog",
+    "getTrackingLog",
+]
+
+
+class CircuitBreaker:
+    """
+    Count based circuit breaker. Opens when at least failure_threshold of the last window_size calls failed
+    (and there were at least minimum_calls), rejects calls for reset_timeout seconds, then lets half_open_calls
+    probes through: a successful probe closes the circuit, a failed one opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=0.5, window_size=20, minimum_calls=10, reset_timeout=30.0,
+                 half_open_calls=1, on_state_change=None):
+        """
+        :param name: name passed to on_state_change, usually the endpoint URI
+        :param failure_threshold: share of failed calls (0..1) to open the circuit
+        :param window_size: number of latest calls to take into account
+        :param minimum_calls: do not open the circuit before that many calls are recorded
+        :param reset_timeout: seconds to stay open before probing
+        :param half_open_calls: number of concurrent probes allowed in half-open state
+        :param on_state_change: (optional) callable(name, old_state, new_state)
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.minimum_calls = minimum_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.on_state_change = on_state_change
+
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window_size)
+        self._opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        old_state, self.state = self.state, state
+        logger.info("Circuit {}: {} -> {}".format(self.name, old_state, state))
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state != HALF_OPEN:
+            self._probes = 0
+        if state == CLOSED:
+            self._outcomes.clear()
+        return old_state, state
+
+    def _notify(self, transition):
+        if transition is not None and self.on_state_change is not None:
+            self.on_state_change(self.name, *transition)
+
+    def allow(self):
+        """
+        :return: True if a call may be made now
+        """
+        transition = None
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                transition = self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    allowed = False
+                else:
+                    self._probes += 1
+                    allowed = True
+            else:
+                allowed = True
+        self._notify(transition)
+        return allowed
+
+    def record_success(self):
+        transition = None
+        with self._lock:
+            if self.state == HALF_OPEN:
+                transition = self._transition(CLOSED)
+            else:
+                self._outcomes.append(True)
+        self._notify(transition)
+
+    def record_failure(self):
+        transition = None
+        with self._lock:
+            if self.state == HALF_OPEN:
+                transition = self._transition(OPEN)
+            elif self.state == CLOSED:
+                self._outcomes.append(False)
+                failures = self._outcomes.count(False)
+                if len(self._outcomes) >= self.minimum_calls and \
+                        failures >= self.failure_threshold * len(self._outcomes):
+                    transition = self._transition(OPEN)
+        self._notify(transition)
+
+
+class _LatencyTracker:
+    """
+    Keeps the latest latencies of successful calls to compute the hedging delay
+    """
+
+    def __init__(self, size):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, percentile, minimum_samples):
+        with self._lock:
+            if len(self._samples) < minimum_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100.0))
+        return samples[index]
+
+
+class Resilience:
+    """
+    Pass an instance to Pushwoosh(..., resilience=Resilience()) to enable circuit breakers and hedged requests:
+
+    def log_transition(uri, old_state, new_state):
+        print(uri, old_state, new_state)
+
+    p = Pushwoosh(api_endpoint, api_key, resilience=Resilience(hedge_percentile=95, on_state_change=log_transition))
+
+    A call is counted as failed when the request raised (timeouts, connection errors) or returned 429/5xx.
+    When the circuit for an endpoint is open, calls raise CircuitOpenError without touching the network.
+    """
+
+    def __init__(self, idempotent_uris=None, hedge=True, hedge_percentile=95, hedge_delay=1.0, hedge_min_samples=20,
+                 latency_window=200, max_workers=8, failure_threshold=0.5, window_size=20, minimum_calls=10,
+                 reset_timeout=30.0, half_open_calls=1, on_state_change=None, on_hedge=None):
+        """
+        :param idempotent_uris: URIs safe to be sent twice. Default: IDEMPOTENT_URIS
+        :param hedge: enable hedged requests for idempotent URIs
+        :param hedge_percentile: latency percentile of an endpoint after which the hedge request is fired
+        :param hedge_delay: delay in seconds used until hedge_min_samples latencies are observed for an endpoint
+        :param hedge_min_samples: number of latencies to observe before using the percentile
+        :param latency_window: number of latest latencies kept per endpoint
+        :param max_workers: size of the thread pool running hedge requests. First attempts run in threads of their own,
+            so the pool only bounds the number of concurrent hedges
+        :param failure_threshold: see CircuitBreaker
+        :param window_size: see CircuitBreaker
+        :param minimum_calls: see CircuitBreaker
+        :param reset_timeout: see CircuitBreaker
+        :param half_open_calls: see CircuitBreaker
+        :param on_state_change: (optional) callable(uri, old_state, new_state) called on circuit transitions
+        :param on_hedge: (optional) callable(uri, delay) called when a hedge request is fired
+        """
+        self.idempotent_uris = set(idempotent_uris if idempotent_uris is not None else IDEMPOTENT_URIS)
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self.max_workers = max_workers
+        self.breaker_options = {
+            "failure_threshold": failure_threshold,
+            "window_size": window_size,
+            "minimum_calls": minimum_calls,
+            "reset_timeout": reset_timeout,
+            "half_open_calls": half_open_calls,
+        }
+        self.on_state_change = on_state_change
+        self.on_hedge = on_hedge
+
+        self._breakers = {}
+        self._latencies = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def breaker(self, uri):
+        """
+        :param uri: relative URI, e.g. "getResults"
+        :return: CircuitBreaker for the endpoint
+        """
+        with self._lock:
+            breaker = self._breakers.get(uri)
+            if breaker is None:
+                breaker = self._breakers[uri] = CircuitBreaker(uri, on_state_change=self.on_state_change,
+                                                               **self.breaker_options)
+            return breaker
+
+    def _latency(self, uri):
+        with self._lock:
+            tracker = self._latencies.get(uri)
+            if tracker is None:
+                tracker = self._latencies[uri] = _LatencyTracker(self.latency_window)
+            return tracker
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="pushwoosh-hedge")
+            return self._executor
+
+    def hedge_delay_for(self, uri):
+        """
+        :return: seconds to wait for the first attempt before firing the hedge request
+        """
+        delay = self._latency(uri).percentile(self.hedge_percentile, self.hedge_min_samples)
+        return delay if delay is not None else self.hedge_delay
+
+    @staticmethod
+    def _failed(response):
+        return response.status_code == 429 or response.status_code >= 500
+
+    @staticmethod
+    def _close_response(future):
+        if not future.cancelled() and future.exception() is None:
+            close = getattr(future.result(), "close", None)
+            if close is not None:
+                close()
+
+    def _discard(self, futures):
+        """
+        Cancels attempts still queued in the pool and closes responses of the ones that lost, now or whenever they
+        complete
+        """
+        for future in futures:
+            if not future.cancel():
+                future.add_done_callback(self._close_response)
+
+    @staticmethod
+    def _start(send):
+        """
+        Runs the first attempt in a thread of its own, so that queueing in the hedge pool never delays it
+        """
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                response = send()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(response)
+
+        threading.Thread(target=run, name="pushwoosh-request", daemon=True).start()
+        return future
+
+    def call(self, uri, send, hedge=True):
+        """
+        Runs send() guarded by the endpoint circuit breaker, hedged if the endpoint is idempotent.
+        :param uri: relative URI of the request
+        :param send: callable without arguments performing the HTTP request and returning the response
+        :param hedge: set to False to never hedge this call, e.g. for streamed responses
+        :return: response object
+        """
+        breaker = self.breaker(uri)
+        if not breaker.allow():
+            raise (CircuitOpenError(uri, "Circuit for {} is open, request is not sent".format(uri)))
+
+        started = time.monotonic()
+        try:
+            if hedge and self.hedge and uri in self.idempotent_uris:
+                response = self._hedged(uri, send)
+            else:
+                response = send()
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        if self._failed(response):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+            self._latency(uri).add(time.monotonic() - started)
+        return response
+
+    def _hedged(self, uri, send):
+        delay = self.hedge_delay_for(uri)
+        submitted = [self._start(send)]
+        done, pending = wait(submitted, timeout=delay)
+
+        if not done:
+            logger.debug("No response from {} in {:.3f}s, sending hedge request".format(uri, delay))
+            if self.on_hedge is not None:
+                self.on_hedge(uri, delay)
+            submitted.append(self._pool().submit(send))
+            pending.add(submitted[-1])
+
+        fallback = None
+        while True:
+            if not done:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and not self._failed(future.result()):
+                    self._discard(other for other in submitted if other is not future)
+                    return future.result()
+                if fallback is None or fallback.exception() is not None:
+                    fallback = future
+            if not pending:
+                self._discard(other for other in submitted if other is not fallback)
+                return fallback.result()
+            done = set()
+
+    def shutdown(self):
+        """
+        Stops the thread pool used for hedged requests
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
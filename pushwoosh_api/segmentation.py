@@ -0,0 +1,552 @@
+import csv
+import logging
+import math
+import re
+
+from array import array
+from bisect import bisect_left, bisect_right
+from .pushwoosh_exceptions import *
+
+logger = logging.getLogger(__name__)
+"""
+Local evaluation of devices_filter expressions, the same syntax accepted by exportSegment:
+https://docs.pushwoosh.com/platform-docs/api-reference/filters#exportsegment
+
+Devices from a snapshot (e.g. an exported segment CSV) are numbered and every tag value gets an inverted index entry.
+Index entries are compressed bitmaps split into blocks of 65536 positions: a block is a sorted array of 16-bit offsets
+while sparse and a bytearray once dense. A query ORs the entries it needs into one result bitmap, a plain Python
+integer (bit N is set when device N matches), so AND/OR/NOT are single bitwise operations regardless of the
+audience size and no per-value bitmap is ever materialized.
+"""
+
+__all__ = ["TAG_OPERATORS", "parse_filter", "SegmentIndex"]
+
+TAG_OPERATORS = ["EQ", "NOTEQ", "IN", "NOTIN", "GTE", "LTE", "BETWEEN", "NOTSET", "ANY"]
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<punct>[()\[\],*+\\])
+""", re.VERBOSE)
+
+_ESCAPE_RE = re.compile(r"\\(.)")
+_NUMBER_RE = re.compile(r"^-?\d+(?:\.\d+)?$")
+
+_BLOCK_BITS = 16
+_BLOCK_MASK = (1 << _BLOCK_BITS) - 1
+_BLOCK_BYTES = 1 << (_BLOCK_BITS - 3)
+# a sparse block of 16-bit offsets takes as much memory as a dense one at this size
+_DENSE_THRESHOLD = _BLOCK_BYTES // 2
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    while position < len(expression):
+        match = _TOKEN_RE.match(expression, position)
+        if match is None:
+            raise (FilterSyntaxError(expression, position,
+                                     "Unexpected character {!r} at position {}".format(expression[position],
+                                                                                      position)))
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "number":
+            tokens.append(("value", float(text) if "." in text else int(text), position))
+        elif kind == "string":
+            tokens.append(("value", _ESCAPE_RE.sub(r"\1", text[1:-1]), position))
+        elif kind == "name" and text.lower() in ["true", "false"]:
+            tokens.append(("value", text.lower() == "true", position))
+        elif kind == "name":
+            tokens.append(("name", text, position))
+        elif kind == "punct":
+            tokens.append((text, text, position))
+        position = match.end()
+    tokens.append(("end", None, len(expression)))
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser producing a tuple based syntax tree:
+    ("app", code, platforms), ("tag", application, name, operator, value), ("and"|"or"|"diff", left, right), ("not", node)
+    "*"/AND and "\\" bind tighter than "+"/OR, NOT binds tightest.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.index = 0
+
+    def _peek(self):
+        return self.tokens[self.index]
+
+    def _next(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def _error(self, token, message):
+        raise (FilterSyntaxError(self.expression, token[2], "{} at position {}".format(message, token[2])))
+
+    def _expect(self, kind):
+        token = self._next()
+        if token[0] != kind:
+            self._error(token, "Expected {!r}, got {!r}".format(kind, token[1]))
+        return token
+
+    def _is_keyword(self, token, *keywords):
+        return token[0] == "name" and token[1].upper() in keywords
+
+    def parse(self):
+        node = self._union()
+        token = self._peek()
+        if token[0] != "end":
+            self._error(token, "Unexpected {!r}".format(token[1]))
+        return node
+
+    def _union(self):
+        node = self._intersection()
+        while self._peek()[0] == "+" or self._is_keyword(self._peek(), "OR"):
+            self._next()
+            node = ("or", node, self._intersection())
+        return node
+
+    def _intersection(self):
+        node = self._unary()
+        while True:
+            token = self._peek()
+            if token[0] == "*" or self._is_keyword(token, "AND"):
+                self._next()
+                node = ("and", node, self._unary())
+            elif token[0] == "\\":
+                self._next()
+                node = ("diff", node, self._unary())
+            else:
+                return node
+
+    def _unary(self):
+        if self._is_keyword(self._peek(), "NOT"):
+            self._next()
+            return ("not", self._unary())
+        return self._primary()
+
+    def _primary(self):
+        token = self._next()
+        if token[0] == "(":
+            node = self._union()
+            self._expect(")")
+            return node
+        if token[0] == "end":
+            self._error(token, "Unexpected end of filter")
+        if token[0] != "name":
+            self._error(token, "Unexpected {!r}".format(token[1]))
+
+        function = token[1].upper()
+        self._expect("(")
+        if function == "A":
+            code = self._string()
+            platforms = None
+            if self._peek()[0] == ",":
+                self._next()
+                platforms = self._list()
+            self._expect(")")
+            return ("app", code, platforms)
+        if function == "T":
+            node = ("tag", None) + self._tag_arguments()
+            self._expect(")")
+            return node
+        if function == "AT":
+            application = self._string()
+            self._expect(",")
+            node = ("tag", application) + self._tag_arguments()
+            self._expect(")")
+            return node
+        self._error(token, "Unknown filter function {!r}".format(token[1]))
+
+    def _tag_arguments(self):
+        name = self._string()
+        self._expect(",")
+        token = self._expect("name")
+        operator = token[1].upper()
+        if operator not in TAG_OPERATORS:
+            self._error(token, "Unknown operator {!r}".format(token[1]))
+
+        value = None
+        if self._peek()[0] == ",":
+            self._next()
+            value = self._list() if self._peek()[0] == "[" else self._expect("value")[1]
+
+        if operator in ["NOTSET", "ANY"]:
+            if value is not None:
+                self._error(token, "Operator {} does not take a value".format(operator))
+        elif value is None:
+            self._error(token, "Operator {} requires a value".format(operator))
+        elif operator in ["IN", "NOTIN", "BETWEEN"]:
+            if not isinstance(value, list):
+                self._error(token, "Operator {} requires a list value".format(operator))
+            if operator == "BETWEEN" and len(value) != 2:
+                self._error(token, "Operator BETWEEN requires exactly two values")
+        elif isinstance(value, list):
+            self._error(token, "Operator {} does not accept a list value".format(operator))
+        return name, operator, value
+
+    def _string(self):
+        token = self._expect("value")
+        if not isinstance(token[1], str):
+            self._error(token, "Expected a string, got {!r}".format(token[1]))
+        return token[1]
+
+    def _list(self):
+        self._expect("[")
+        values = []
+        if self._peek()[0] != "]":
+            values.append(self._expect("value")[1])
+            while self._peek()[0] == ",":
+                self._next()
+                values.append(self._expect("value")[1])
+        self._expect("]")
+        return values
+
+
+def parse_filter(devices_filter):
+    """
+    Parses a devices_filter expression, e.g. 'A("AAAAA-BBBBB") * T("Age", GTE, 18) \\ T("Language", EQ, "de")'
+    AND, OR and NOT keywords are accepted as aliases for "*", "+" and "universe minus" respectively.
+    :param devices_filter: filter string
+    :return: syntax tree of nested tuples
+    """
+    return _Parser(devices_filter).parse()
+
+
+def _normalize(value):
+    """
+    Brings snapshot and filter values to comparable keys: numbers and plain decimal strings ("18", "-1.5") become
+    floats, booleans and everything else (including "1e3", "nan", "inf") are compared as strings.
+    """
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, str) and value.lower() in ["true", "false"]:
+        return value.lower()
+    if isinstance(value, (int, float)):
+        return float(value) if math.isfinite(value) else str(value)
+    value = str(value)
+    if _NUMBER_RE.match(value):
+        return float(value)
+    return value
+
+
+def _count_bits(bitmap):
+    return bitmap.bit_count() if hasattr(bitmap, "bit_count") else bin(bitmap).count("1")
+
+
+def _iter_bits(bitmap):
+    """
+    Yields positions of set bits in ascending order
+    """
+    bits = bin(bitmap)[:1:-1]
+    position = bits.find("1")
+    while position != -1:
+        yield position
+        position = bits.find("1", position + 1)
+
+
+class _Bitmap:
+    """
+    Compressed set of device positions, split into blocks of 65536 positions. A block is kept as a sorted
+    array("H") of offsets until it holds more than _DENSE_THRESHOLD positions, then as a bytearray bitmap.
+    """
+    __slots__ = ["blocks"]
+
+    def __init__(self):
+        self.blocks = {}
+
+    def add(self, position):
+        key, offset = position >> _BLOCK_BITS, position & _BLOCK_MASK
+        block = self.blocks.get(key)
+        if block is None:
+            self.blocks[key] = array("H", [offset])
+            return
+        if isinstance(block, bytearray):
+            block[offset >> 3] |= 1 << (offset & 7)
+            return
+        if block[-1] < offset:
+            block.append(offset)
+        else:
+            i = bisect_left(block, offset)
+            if i < len(block) and block[i] == offset:
+                return
+            block.insert(i, offset)
+        if len(block) > _DENSE_THRESHOLD:
+            dense = bytearray(_BLOCK_BYTES)
+            for offset in block:
+                dense[offset >> 3] |= 1 << (offset & 7)
+            self.blocks[key] = dense
+
+    def or_into(self, bits):
+        """
+        Sets the bits of this bitmap in bits, a bytearray covering whole blocks
+        """
+        for key, block in self.blocks.items():
+            base = key << _BLOCK_BITS
+            if isinstance(block, bytearray):
+                start = base >> 3
+                stop = start + _BLOCK_BYTES
+                merged = int.from_bytes(bits[start:stop], "little") | int.from_bytes(block, "little")
+                bits[start:stop] = merged.to_bytes(_BLOCK_BYTES, "little")
+            else:
+                for offset in block:
+                    position = base + offset
+                    bits[position >> 3] |= 1 << (position & 7)
+
+
+def _union(bitmaps, size):
+    """
+    :param bitmaps: iterable of _Bitmap or None
+    :param size: number of positions in the snapshot
+    :return: bitmap (int) of positions set in any of the bitmaps
+    """
+    bits = None
+    for bitmap in bitmaps:
+        if bitmap is not None and bitmap.blocks:
+            if bits is None:
+                bits = bytearray(((size >> _BLOCK_BITS) + 1) * _BLOCK_BYTES)
+            bitmap.or_into(bits)
+    return int.from_bytes(bits, "little") if bits is not None else 0
+
+
+class _TagIndex:
+    """
+    Inverted index for one tag: value -> bitmap, plus sorted keys for range operators.
+    Lookups return lists of bitmaps to be merged with _union().
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.any = _Bitmap()
+        self._numbers = None
+        self._strings = None
+
+    def add(self, value, position):
+        key = _normalize(value)
+        bitmap = self.values.get(key)
+        if bitmap is None:
+            bitmap = self.values[key] = _Bitmap()
+            self._numbers = None
+            self._strings = None
+        bitmap.add(position)
+        self.any.add(position)
+
+    def _sorted_keys(self, bound):
+        if self._numbers is None:
+            self._numbers = sorted(key for key in self.values if isinstance(key, float))
+            self._strings = sorted(key for key in self.values if isinstance(key, str))
+        return self._numbers if isinstance(bound, float) else self._strings
+
+    def one_of(self, values):
+        return [self.values.get(_normalize(value)) for value in values]
+
+    def between(self, low=None, high=None):
+        low = _normalize(low) if low is not None else None
+        high = _normalize(high) if high is not None else None
+        if low is not None and high is not None and type(low) is not type(high):
+            return []
+        keys = self._sorted_keys(low if low is not None else high)
+        start = bisect_left(keys, low) if low is not None else 0
+        stop = bisect_right(keys, high) if high is not None else len(keys)
+        return [self.values[key] for key in keys[start:stop]]
+
+
+class SegmentIndex:
+    """
+    In-memory snapshot of devices and their tags, able to answer devices_filter queries without calling the API.
+
+    index = SegmentIndex()
+    index.load_csv("segment.csv", application="AAAAA-BBBBB")
+    index.count('A("AAAAA-BBBBB") * T("Language", IN, ["de", "fr"])')
+
+    List tags are indexed per element, so EQ/IN on a list tag match devices whose list contains the value.
+    NOTEQ, NOTIN and NOTSET are evaluated against the whole snapshot, i.e. they include devices without the tag.
+    """
+
+    def __init__(self):
+        self.hwids = []
+        self._positions = {}
+        self._applications = {}
+        self._platforms = {}
+        self._tags = {}
+        self._compiled = {}
+
+    def __len__(self):
+        return len(self.hwids)
+
+    def add_device(self, hwid, application, tags=None, platform=None):
+        """
+        Adds a device to the snapshot. Adding the same hwid again merges its applications and tags.
+        :param hwid: hardware ID
+        :param application: application code (AAAAA-BBBBB)
+        :param tags: dict of tag name -> value; list values are indexed per element, None values are skipped
+        :param platform: optional platform name as used in A("code", ["iOS", "Android"])
+        :return: position of the device in the snapshot
+        """
+        position = self._positions.get(hwid)
+        if position is None:
+            position = len(self.hwids)
+            self._positions[hwid] = position
+            self.hwids.append(hwid)
+
+        if application is not None:
+            self._applications.setdefault(application, _Bitmap()).add(position)
+        if platform is not None:
+            self._platforms.setdefault(platform, _Bitmap()).add(position)
+
+        for name, value in (tags or {}).items():
+            if value is None or value == "":
+                continue
+            tag = self._tags.get(name)
+            if tag is None:
+                tag = self._tags[name] = _TagIndex()
+            for item in (value if isinstance(value, (list, tuple, set)) else [value]):
+                tag.add(item, position)
+        return position
+
+    def load_devices(self, devices, hwid_field="hwid", application_field="application", tags_field="tags",
+                     platform_field="platform"):
+        """
+        Adds devices from an iterable of dicts, e.g. {"hwid": "...", "application": "...", "tags": {...}}
+        :return: number of devices processed
+        """
+        count = 0
+        for device in devices:
+            self.add_device(device[hwid_field], device.get(application_field), device.get(tags_field),
+                            device.get(platform_field))
+            count += 1
+        logger.debug("Loaded {} devices, snapshot size: {}".format(count, len(self.hwids)))
+        return count
+
+    def load_csv(self, path, application=None, hwid_column="Hwid", application_column=None, platform_column=None,
+                 tag_columns=None, delimiter=","):
+        """
+        Adds devices from a CSV file, such as the one linked from exportSegment results.
+        :param path: path to the CSV file
+        :param application: application code for all rows, if the file has no application column
+        :param hwid_column: name of the column with hardware IDs
+        :param application_column: (optional) name of the column with application codes
+        :param platform_column: (optional) name of the column with platform names
+        :param tag_columns: (optional) list of columns to index as tags. By default all other columns are used.
+        :param delimiter: CSV delimiter
+        :return: number of devices processed
+        """
+        service_columns = {hwid_column, application_column, platform_column}
+        with open(path, newline="") as f:
+            reader = csv.DictReader(f, delimiter=delimiter)
+            columns = tag_columns if tag_columns is not None else \
+                [column for column in reader.fieldnames if column not in service_columns]
+
+            def devices():
+                for row in reader:
+                    yield {
+                        "hwid": row[hwid_column],
+                        "application": row[application_column] if application_column else application,
+                        "platform": row[platform_column] if platform_column else None,
+                        "tags": {column: row.get(column) for column in columns}
+                    }
+
+            return self.load_devices(devices())
+
+    def _universe(self):
+        return (1 << len(self.hwids)) - 1
+
+    def _union(self, bitmaps):
+        return _union(bitmaps, len(self.hwids))
+
+    def compile(self, devices_filter):
+        """
+        Parses and compiles the filter into a function returning the bitmap of matching devices.
+        Compiled filters are cached by their text and keep working after more devices are added.
+        :param devices_filter: filter string
+        :return: callable without arguments returning a bitmap (int)
+        """
+        compiled = self._compiled.get(devices_filter)
+        if compiled is None:
+            compiled = self._compiled[devices_filter] = self._compile(parse_filter(devices_filter))
+        return compiled
+
+    def _compile(self, node):
+        kind = node[0]
+        if kind == "and":
+            left, right = self._compile(node[1]), self._compile(node[2])
+            return lambda: left() & right()
+        if kind == "or":
+            left, right = self._compile(node[1]), self._compile(node[2])
+            return lambda: left() | right()
+        if kind == "diff":
+            left, right = self._compile(node[1]), self._compile(node[2])
+            return lambda: left() & ~right()
+        if kind == "not":
+            operand = self._compile(node[1])
+            return lambda: self._universe() & ~operand()
+        if kind == "app":
+            return self._compile_app(node[1], node[2])
+        return self._compile_tag(*node[1:])
+
+    def _compile_app(self, code, platforms):
+        def evaluate():
+            result = self._union([self._applications.get(code)])
+            if platforms is not None:
+                result &= self._union(self._platforms.get(platform) for platform in platforms)
+            return result
+        return evaluate
+
+    def _compile_tag(self, application, name, operator, value):
+        def select(tag):
+            if operator == "EQ":
+                return self._union(tag.one_of([value]))
+            if operator == "NOTEQ":
+                return self._universe() & ~self._union(tag.one_of([value]))
+            if operator == "IN":
+                return self._union(tag.one_of(value))
+            if operator == "NOTIN":
+                return self._universe() & ~self._union(tag.one_of(value))
+            if operator == "GTE":
+                return self._union(tag.between(low=value))
+            if operator == "LTE":
+                return self._union(tag.between(high=value))
+            if operator == "BETWEEN":
+                return self._union(tag.between(low=value[0], high=value[1]))
+            if operator == "ANY":
+                return self._union([tag.any])
+            return self._universe() & ~self._union([tag.any])
+
+        empty = _TagIndex()
+
+        def evaluate():
+            result = select(self._tags.get(name, empty))
+            if application is not None:
+                result &= self._union([self._applications.get(application)])
+            return result
+        return evaluate
+
+    def bitmap(self, devices_filter):
+        """
+        :param devices_filter: filter string
+        :return: bitmap (int) of matching device positions
+        """
+        return self.compile(devices_filter)()
+
+    def count(self, devices_filter):
+        """
+        Audience size for the filter
+        :param devices_filter: filter string
+        :return: number of matching devices
+        """
+        return _count_bits(self.bitmap(devices_filter))
+
+    def devices(self, devices_filter):
+        """
+        Generator of hwids matching the filter, in the order they were added to the snapshot
+        :param devices_filter: filter string
+        """
+        for position in _iter_bits(self.bitmap(devices_filter)):
+            yield self.hwids[position]
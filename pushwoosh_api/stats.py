@@ -0,0 +1,290 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+"""
+Batch runner for the asynchronous statistics endpoints (getMsgStats, getMsgPlatformsStats, getAppStats,
+getCampaignStats, getEventStatistics). Jobs are scheduled with bounded concurrency and polled through getResults
+from a single loop; results are normalized into a columnar StatsTable.
+"""
+
+__all__ = ["STATS_MESSAGE", "STATS_MESSAGE_PLATFORMS", "STATS_APPLICATION", "STATS_CAMPAIGN", "STATS_EVENT",
+           "StatsJob", "StatsTable", "StatsRunner", "normalize_stats"]
+
+STATS_MESSAGE = "message"
+STATS_MESSAGE_PLATFORMS = "message_platforms"
+STATS_APPLICATION = "application"
+STATS_CAMPAIGN = "campaign"
+STATS_EVENT = "event"
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _format_datetime(value, end_of_day=False):
+    if value is None or isinstance(value, str):
+        return value
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.max.time() if end_of_day else datetime.min.time())
+    return value.strftime(DATETIME_FORMAT)
+
+
+class StatsJob:
+    """
+    One statistics request: kind is one of STATS_MESSAGE, STATS_MESSAGE_PLATFORMS, STATS_APPLICATION,
+    STATS_CAMPAIGN, STATS_EVENT. entity is a message code, application code or campaign code.
+    For STATS_EVENT jobs entity is the application code and event is the event name.
+    Dates are date/datetime objects or "Y-m-d H:i:s" strings; date_to of a date object means the end of that day.
+    """
+
+    def __init__(self, kind, entity, date_from=None, date_to=None, event=None):
+        self.kind = kind
+        self.entity = entity
+        self.date_from = _format_datetime(date_from)
+        self.date_to = _format_datetime(date_to, end_of_day=True)
+        self.event = event
+
+    def __repr__(self):
+        return "StatsJob({!r}, {!r}, {!r}, {!r}, {!r})".format(self.kind, self.entity, self.date_from, self.date_to,
+                                                                self.event)
+
+    @property
+    def key(self):
+        return "|".join(str(part) for part in [self.kind, self.entity, self.event, self.date_from, self.date_to])
+
+    def is_closed(self, today=None):
+        """
+        :return: True if the job covers a date range that ended before today, i.e. its statistics will not change
+        """
+        if self.date_to is None:
+            return False
+        today = today or datetime.now(timezone.utc).date()
+        return self.date_to[:10] < today.isoformat()
+
+    def submit(self, pushwoosh):
+        """
+        :return: request_id of the scheduled job or response object in case of error
+        """
+        if self.kind == STATS_MESSAGE:
+            return pushwoosh.get_msg_stats(self.entity)
+        if self.kind == STATS_MESSAGE_PLATFORMS:
+            return pushwoosh.get_msg_platforms_stats(self.entity)
+        if self.kind == STATS_APPLICATION:
+            return pushwoosh.get_app_stats(self.entity, self.date_from, self.date_to)
+        if self.kind == STATS_CAMPAIGN:
+            return pushwoosh.get_campaign_stats(self.entity, self.date_from, self.date_to)
+        if self.kind == STATS_EVENT:
+            return pushwoosh.get_event_statistics(self.entity, self.event, self.date_from, self.date_to)
+        raise ValueError("Unknown statistics kind: {}".format(self.kind))
+
+
+class StatsTable:
+    """
+    Columnar table with (entity, date, platform, action, count) rows.
+    String columns are stored as indexes into a shared dictionary of values, counts in an array of integers.
+    """
+    COLUMNS = ["entity", "date", "platform", "action", "count"]
+
+    def __init__(self):
+        self._values = []
+        self._codes = {}
+        self._columns = [array("l") for _ in range(4)]
+        self.counts = array("q")
+
+    def _code(self, value):
+        value = "" if value is None else str(value)
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.counts)
+
+    def append(self, entity, date, platform, action, count):
+        for column, value in zip(self._columns, [entity, date, platform, action]):
+            column.append(self._code(value))
+        self.counts.append(int(count or 0))
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(*row)
+
+    def __iter__(self):
+        values = self._values
+        entities, dates, platforms, actions = self._columns
+        for i in range(len(self.counts)):
+            yield values[entities[i]], values[dates[i]], values[platforms[i]], values[actions[i]], self.counts[i]
+
+    def column(self, name):
+        """
+        :param name: one of StatsTable.COLUMNS
+        :return: list of column values
+        """
+        if name == "count":
+            return list(self.counts)
+        values = self._values
+        return [values[code] for code in self._columns[self.COLUMNS.index(name)]]
+
+    def aggregate(self, *columns):
+        """
+        Sums counts grouped by the given columns, e.g. table.aggregate("entity", "action")
+        :return: dict of tuple(column values) -> total count
+        """
+        keys = [self._columns[self.COLUMNS.index(name)] for name in columns]
+        totals = {}
+        for i, count in enumerate(self.counts):
+            key = tuple(column[i] for column in keys)
+            totals[key] = totals.get(key, 0) + count
+        values = self._values
+        return {tuple(values[code] for code in key): total for key, total in totals.items()}
+
+
+def normalize_stats(entity, result):
+    """
+    Converts a getResults response of a statistics job into (entity, date, platform, action, count) rows.
+    Handles "rows" lists of {"datetime", "platform", "action"|"event", "count"} as well as nested
+    {platform: {action: count}} dictionaries.
+    :param entity: entity the statistics belong to
+    :param result: response object from get_results()
+    :return: list of row tuples or None if the response shape is not recognized
+    """
+    response = result.get("response")
+    if not isinstance(response, dict):
+        return None
+    rows = []
+    if isinstance(response.get("rows"), list):
+        for row in response["rows"]:
+            if not isinstance(row, dict):
+                return None
+            rows.append((entity,
+                         row.get("datetime", row.get("date")),
+                         row.get("platform"),
+                         row.get("action", row.get("event")),
+                         row.get("count", 0)))
+    else:
+        for platform, actions in response.items():
+            if isinstance(actions, dict):
+                for action, count in actions.items():
+                    if isinstance(count, (int, float)):
+                        rows.append((entity, None, platform, action, count))
+            elif isinstance(actions, (int, float)):
+                rows.append((entity, None, None, platform, actions))
+        if not rows:
+            return None
+    return rows
+
+
+class StatsRunner:
+    """
+    Submits statistics jobs for many entities with at most max_pending jobs scheduled at once and polls their
+    results from a single loop:
+
+    runner = StatsRunner(Pushwoosh(...), max_pending=20, cache_dir="stats_cache")
+    jobs = [StatsJob(STATS_CAMPAIGN, code, date(2021, 1, 1), date(2021, 1, 31)) for code in campaigns]
+    table = runner.run(jobs)
+    table.aggregate("entity", "action")
+
+    Results of jobs with a closed date range (ending before today, UTC) are stored in cache_dir and reused.
+    Jobs that could not be scheduled, were not resolved within job_timeout or returned results in an unknown format
+    are collected in runner.failed as (job, response) tuples.
+    """
+
+    def __init__(self, pushwoosh, max_pending=10, poll_interval=5.0, cache_dir=None, job_timeout=3600.0):
+        """
+        :param pushwoosh: Pushwoosh instance
+        :param max_pending: maximum number of jobs scheduled and not yet resolved
+        :param poll_interval: seconds between polling rounds in which no job completed
+        :param cache_dir: (optional) directory to keep results of closed date ranges
+        :param job_timeout: seconds after scheduling a job to stop waiting for its results
+        """
+        self.pushwoosh = pushwoosh
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.cache_dir = cache_dir
+        self.failed = []
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _cache_path(self, job):
+        return os.path.join(self.cache_dir, hashlib.sha1(job.key.encode("utf-8")).hexdigest() + ".json")
+
+    def _cache_get(self, job):
+        if self.cache_dir is None or not job.is_closed():
+            return None
+        try:
+            with open(self._cache_path(job)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _cache_put(self, job, rows):
+        if self.cache_dir is None or not rows or not job.is_closed():
+            return
+        path = self._cache_path(job)
+        with open(path + ".tmp", "w") as f:
+            json.dump(rows, f)
+        os.replace(path + ".tmp", path)
+
+    def run(self, jobs):
+        """
+        :param jobs: iterable of StatsJob
+        :return: StatsTable with rows of all resolved jobs
+        """
+        table = StatsTable()
+        queue = deque()
+        for job in jobs:
+            rows = self._cache_get(job)
+            if rows is not None:
+                logger.debug("Using cached statistics for {}".format(job))
+                table.extend(rows)
+            else:
+                queue.append(job)
+
+        pending = deque()
+        while queue or pending:
+            while queue and len(pending) < self.max_pending:
+                job = queue.popleft()
+                request_id = job.submit(self.pushwoosh)
+                if isinstance(request_id, str):
+                    pending.append((job, request_id, time.monotonic() + self.job_timeout))
+                else:
+                    logger.error("Could not schedule {}: {}".format(job, request_id))
+                    self.failed.append((job, request_id))
+
+            completed = 0
+            for _ in range(len(pending)):
+                job, request_id, deadline = pending.popleft()
+                result = self.pushwoosh.get_results(request_id)
+                if result.get("status_code") != 200:
+                    if time.monotonic() < deadline:
+                        pending.append((job, request_id, deadline))
+                    else:
+                        logger.error("No results for {} ({}) in {}s: {}".format(job, request_id, self.job_timeout,
+                                                                                result))
+                        self.failed.append((job, result))
+                        completed += 1
+                    continue
+                completed += 1
+                rows = normalize_stats(job.entity, result)
+                if rows is None:
+                    logger.error("Unknown statistics format for {}: {}".format(job, result))
+                    self.failed.append((job, result))
+                    continue
+                self._cache_put(job, rows)
+                table.extend(rows)
+
+            logger.info("Statistics jobs: {} completed, {} pending, {} queued".format(completed, len(pending),
+                                                                                      len(queue)))
+            if pending and not completed:
+                time.sleep(self.poll_interval)
+        return table
@@ -0,0 +1,271 @@
+import codecs
+import json
+import logging
+import os
+import threading
+
+from datetime import datetime, timedelta, timezone
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from .pushwoosh_exceptions import *
+
+logger = logging.getLogger(__name__)
+"""
+Multi-day retrieval of getTrackingLog with incremental parsing: responses are read in chunks and events are decoded
+one by one from the events array of the document, so a day of tracking log is never materialized in memory.
+"""
+
+__all__ = ["iter_json_array", "TrackingLogDownloader"]
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_SEPARATORS = " \t\n\r,"
+_TERMINATORS = _SEPARATORS + "]"
+
+
+def _decode_chunks(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _find_array(chunks, key):
+    """
+    Reads chunks until the opening bracket of the array
+    :return: (text before the array, buffer, position after the bracket); position is None if there is no array
+    """
+    head = []
+    buffer = ""
+    in_string = False
+    escape = False
+    found = key is None
+    string = None
+    member = False
+
+    while True:
+        string_start = 0
+        for i in range(len(buffer)):
+            c = buffer[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif c == "\\":
+                    escape = True
+                elif c == '"':
+                    in_string = False
+                    if string is not None:
+                        string.append(buffer[string_start:i])
+                        member = "".join(string) == key
+                        string = None
+            elif c == '"':
+                in_string = True
+                if not found:
+                    string_start = i + 1
+                    string = []
+            elif member and c == ":":
+                found = True
+                member = False
+            elif c == "[" and found:
+                head.append(buffer[:i])
+                return "".join(head), buffer, i + 1
+            elif c not in _SEPARATORS:
+                member = False
+        if string is not None:
+            string.append(buffer[string_start:])
+        head.append(buffer)
+        buffer = next(chunks, None)
+        if buffer is None:
+            return "".join(head), "", None
+
+
+def iter_json_array(chunks, key=None, on_prefix=None, on_suffix=None):
+    """
+    Yields elements of an array in a JSON document, reading the document chunk by chunk.
+    E.g. for {"status_code": 200, "response": {"rows": [{...}, {...}]}} it yields the rows one by one.
+    :param chunks: iterable of bytes or str pieces of the document, e.g. response.iter_content()
+    :param key: (optional) member name the array belongs to: the first array after "key": is used, so arrays in
+        earlier members are skipped. By default the first array in the document is used.
+    :param on_prefix: (optional) callable receiving the text before the array, e.g. to check the response envelope.
+        If the document has no array, it receives the whole document before EmptyJsonResponse is raised.
+    :param on_suffix: (optional) callable receiving the text after the array, once the array is exhausted
+    :raises EmptyJsonResponse: if the document has no array
+    :raises JSONDecodeError: if an element is malformed or the array is not terminated
+    """
+    chunks = _decode_chunks(chunks)
+    prefix, buffer, position = _find_array(chunks, key)
+    if on_prefix is not None:
+        on_prefix(prefix)
+    if position is None:
+        raise (EmptyJsonResponse(prefix, "No JSON array in response: {}".format(prefix[:200])))
+
+    exhausted = False
+    while True:
+        while position < len(buffer) and buffer[position] in _SEPARATORS:
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            if on_suffix is not None:
+                on_suffix(buffer[position + 1:] + "".join(chunks))
+            return
+
+        end = None
+        if position < len(buffer):
+            try:
+                item, end = _decoder.raw_decode(buffer, position)
+            except ValueError:
+                if exhausted:
+                    raise
+        # a value is complete only when followed by a separator: "12." or "tru" may continue in the next chunk
+        if end is not None and end < len(buffer) and buffer[end] not in _TERMINATORS:
+            if exhausted:
+                raise json.JSONDecodeError("Unexpected character after array element", buffer, end)
+            end = None
+        if end is None or (end == len(buffer) and not exhausted):
+            if exhausted:
+                raise json.JSONDecodeError("Unterminated array", buffer, position)
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+            else:
+                buffer, position = buffer[position:] + chunk, 0
+            continue
+
+        yield item
+        position = end
+        if position > CHUNK_SIZE:
+            buffer, position = buffer[position:], 0
+
+
+class TrackingLogDownloader:
+    """
+    Fetches tracking logs for a range of days with a bounded number of parallel requests.
+
+    downloader = TrackingLogDownloader(Pushwoosh(...), directory="tracking_log", max_workers=4)
+    downloader.download(date(2021, 1, 1), date(2021, 3, 31))   # one <directory>/2021-01-01.jsonl file per day
+    for day, event in downloader.events(date(2021, 4, 1), date(2021, 4, 7)):
+        ...
+    """
+
+    def __init__(self, pushwoosh, directory=None, max_workers=4, date_format="%Y-%m-%d", queue_size=10000):
+        """
+        :param pushwoosh: Pushwoosh instance
+        :param directory: (optional) directory for per-day JSON lines files, required for download()
+        :param max_workers: number of days fetched in parallel
+        :param date_format: format of the date passed to getTrackingLog
+        :param queue_size: maximum number of parsed events buffered between workers and the events() consumer
+        """
+        self.pushwoosh = pushwoosh
+        self.directory = directory
+        self.max_workers = max_workers
+        self.date_format = date_format
+        self.queue_size = queue_size
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def days(date_from, date_to):
+        """
+        :return: list of dates from date_from to date_to inclusive
+        """
+        return [date_from + timedelta(days=i) for i in range((date_to - date_from).days + 1)]
+
+    def path(self, day):
+        """
+        :return: path of the JSON lines file for the day
+        """
+        return os.path.join(self.directory, "{}.jsonl".format(day.isoformat()))
+
+    def _fetch(self, day):
+        return self.pushwoosh.tracking_log_generator(day.strftime(self.date_format))
+
+    def _download_day(self, day):
+        path = self.path(day)
+        partial = path + ".part"
+        count = 0
+        try:
+            with open(partial, "w") as f:
+                for event in self._fetch(day):
+                    f.write(json.dumps(event))
+                    f.write("\n")
+                    count += 1
+        except Exception:
+            os.remove(partial)
+            raise
+        os.replace(partial, path)
+        logger.info("Tracking log for {}: {} events saved to {}".format(day, count, path))
+        return count
+
+    def download(self, date_from, date_to):
+        """
+        Saves tracking logs for the days from date_from to date_to inclusive, one event per line.
+        Days that already have a complete file are skipped; a day is written to a ".part" file first and renamed
+        when the whole response is parsed, so interrupted or failed downloads are fetched again.
+        Today and future days (UTC) are not downloaded, as their logs are not complete yet.
+        If a day fails, days not started yet are cancelled and the error is raised; finished days are kept.
+        :param date_from: first day, datetime.date
+        :param date_to: last day, datetime.date
+        :return: dict of day -> number of saved events, for the days fetched in this call
+        """
+        if self.directory is None:
+            raise ValueError("directory is required to download tracking logs")
+
+        today = datetime.now(timezone.utc).date()
+        if date_to >= today:
+            logger.info("Tracking log for {} and later days is not complete yet, skipping".format(today))
+            date_to = today - timedelta(days=1)
+
+        days = [day for day in self.days(date_from, date_to) if not os.path.exists(self.path(day))]
+        logger.info("Downloading tracking log for {} days".format(len(days)))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(days, executor.map(self._download_day, days)))
+
+    def events(self, date_from, date_to):
+        """
+        Generator of (day, event) tuples for the days from date_from to date_to inclusive.
+        Days are fetched in parallel, so events of different days are interleaved.
+        :param date_from: first day, datetime.date
+        :param date_to: last day, datetime.date
+        """
+        days = self.days(date_from, date_to)
+        events = Queue(maxsize=self.queue_size)
+        done = object()
+        stop = threading.Event()
+
+        def produce(day):
+            if stop.is_set():
+                return
+            try:
+                for event in self._fetch(day):
+                    if stop.is_set():
+                        return
+                    events.put((day, event))
+            except Exception as e:
+                events.put((day, e))
+                return
+            events.put((day, done))
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for day in days:
+                executor.submit(produce, day)
+            remaining = len(days)
+            while remaining:
+                day, event = events.get()
+                if event is done:
+                    remaining -= 1
+                elif isinstance(event, Exception):
+                    raise event
+                else:
+                    yield day, event
+        finally:
+            stop.set()
+            while not events.empty():
+                events.get_nowait()
+            executor.shutdown(wait=False)
@@ -0,0 +1,296 @@
+import codecs
+import functools
+import gzip
+import json
+import logging
+import tempfile
+import threading
+import time
+
+from collections import deque
+
+import requests
+
+from tenacity import stop_after_attempt
+from .pushwoosh_exceptions import *
+
+logger = logging.getLogger(__name__)
+"""
+Pluggable transports for Pushwoosh and IntegrationAPI clients. A transport is any object with a requests-like
+post(url, data=None, **kwargs) method. RecordingTransport writes real exchanges to a gzipped JSON lines cassette,
+ReplayTransport serves them back without network access, at recorded or accelerated speed.
+"""
+
+__all__ = ["RecordingTransport", "ReplayTransport", "ReplayResponse", "load_cassette"]
+
+
+def _uri(url):
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+def _mask(data):
+    """
+    Removes the API key from a request body, so cassettes can be shared and matched regardless of the key
+    """
+    if not data:
+        return data
+    try:
+        body = json.loads(data)
+    except ValueError:
+        return data
+    if isinstance(body, dict) and isinstance(body.get("request"), dict):
+        body["request"].pop("auth", None)
+    return json.dumps(body, sort_keys=True)
+
+
+def load_cassette(path):
+    """
+    :param path: path to a cassette written by RecordingTransport
+    :return: list of exchange dicts in the order they were recorded
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RecordingTransport:
+    """
+    Sends requests through `requests` and records every exchange to a cassette:
+
+    transport = RecordingTransport("traffic.jsonl.gz")
+    p = Pushwoosh(api_endpoint, api_key, transport=transport)
+    ...
+    transport.close()
+
+    Recorded fields: offset from the start of the recording, URL, request body (without API key), status, reason,
+    headers, response body and elapsed time until the response headers.
+
+    Successful streamed responses (stream=True) are not read up front: chunks from iter_content() are copied to a
+    temporary file as the caller reads them, and the exchange is written to the cassette once the response is read
+    to the end or closed, so streaming keeps its memory profile while recording. A streamed response closed early
+    is recorded as far as it was read.
+    """
+
+    _COPY_SIZE = 64 * 1024
+
+    def __init__(self, path, transport=None):
+        """
+        :param path: cassette path, a new recording is started if the file exists
+        :param transport: (optional) transport to record, by default the requests module
+        """
+        self.path = path
+        self.transport = transport if transport is not None else requests
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def post(self, url, data=None, **kwargs):
+        started = time.monotonic()
+        response = self.transport.post(url, data=data, **kwargs)
+        exchange = {
+            "offset": round(started - self._started, 6),
+            "uri": _uri(url),
+            "url": url,
+            "request": _mask(data),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "elapsed": round(time.monotonic() - started, 6),
+        }
+        if kwargs.get("stream") and response.ok:
+            return _RecordingResponse(self, response, exchange)
+
+        exchange["body"] = response.text
+        with self._lock:
+            self._file.write(json.dumps(exchange))
+            self._file.write("\n")
+        return response
+
+    def _write_streamed(self, exchange, spool):
+        """
+        Writes an exchange which body is kept in a text file, without loading the body in memory
+        """
+        head = json.dumps(exchange)
+        spool.seek(0)
+        with self._lock:
+            self._file.write(head[:-1])
+            self._file.write(', "body": "')
+            while True:
+                block = spool.read(self._COPY_SIZE)
+                if not block:
+                    break
+                self._file.write(json.dumps(block)[1:-1])
+            self._file.write('"}\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _RecordingResponse:
+    """
+    Proxy of a streamed response, copying chunks read through iter_content() to a temporary file
+    """
+
+    def __init__(self, recorder, response, exchange):
+        self._recorder = recorder
+        self._response = response
+        self._exchange = exchange
+        self._spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for chunk in self._response.iter_content(chunk_size=chunk_size, decode_unicode=decode_unicode):
+            if self._spool is not None:
+                self._spool.write(chunk if isinstance(chunk, str) else self._decoder.decode(chunk))
+            yield chunk
+        self._finish()
+
+    def _finish(self):
+        spool, self._spool = self._spool, None
+        if spool is None:
+            return
+        try:
+            spool.write(self._decoder.decode(b"", final=True))
+            self._recorder._write_streamed(self._exchange, spool)
+        finally:
+            spool.close()
+
+    def close(self):
+        self._finish()
+        self._response.close()
+
+
+class ReplayResponse:
+    """
+    Minimal stand-in for requests.Response built from a recorded exchange
+    """
+
+    def __init__(self, exchange):
+        self.url = exchange["url"]
+        self.status_code = exchange["status"]
+        self.reason = exchange.get("reason")
+        self.headers = exchange.get("headers") or {}
+        self.text = exchange["body"]
+        self.content = self.text.encode("utf-8")
+        self.elapsed = exchange.get("elapsed", 0.0)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        data = self.text if decode_unicode else self.content
+        chunk_size = chunk_size or len(data) or 1
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class ReplayTransport:
+    """
+    Serves responses from a cassette instead of sending requests.
+
+    transport = ReplayTransport("traffic.jsonl.gz", speed=10.0, latency=0.05)
+    p = Pushwoosh(api_endpoint, api_key, transport=transport)
+    transport.run(p)   # re-issues the recorded requests through the client, paced as recorded
+
+    Requests are matched by URI and body (API key ignored); equal requests get their responses in recorded order.
+    With strict=False an unmatched request gets the next unused response recorded for the same URI.
+    """
+
+    def __init__(self, path, speed=1.0, latency=0.0, strict=False):
+        """
+        :param path: cassette path
+        :param speed: replay speed multiplier for recorded response times, None to respond immediately
+        :param latency: extra seconds added to every response
+        :param strict: raise CassetteError if no exchange matches the request body
+        """
+        self.path = path
+        self.speed = speed
+        self.latency = latency
+        self.strict = strict
+        self.exchanges = load_cassette(path)
+
+        self._by_request = {}
+        self._by_uri = {}
+        for index, exchange in enumerate(self.exchanges):
+            self._by_request.setdefault((exchange["uri"], exchange["request"]), deque()).append(index)
+            self._by_uri.setdefault(exchange["uri"], deque()).append(index)
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def _next(self, queue):
+        while queue:
+            index = queue.popleft()
+            if index not in self._used:
+                self._used.add(index)
+                return self.exchanges[index]
+        return None
+
+    def _delay(self, seconds):
+        if self.speed:
+            seconds = seconds / self.speed
+        else:
+            seconds = 0.0
+        seconds += self.latency
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def post(self, url, data=None, **kwargs):
+        uri = _uri(url)
+        with self._lock:
+            exchange = self._next(self._by_request.get((uri, _mask(data)), deque()))
+            if exchange is None and not self.strict:
+                exchange = self._next(self._by_uri.get(uri, deque()))
+        if exchange is None:
+            raise (CassetteError(url, data, "No recorded response for {} in {}".format(url, self.path)))
+
+        self._delay(exchange.get("elapsed", 0.0))
+        return ReplayResponse(exchange)
+
+    def run(self, client, paced=True):
+        """
+        Re-issues all recorded requests through client._send_request() in recorded order, e.g. to profile
+        the client on a captured day of traffic. Responses come from this transport if the client uses it.
+        Every exchange is sent exactly once: retries of _send_request are disabled, as recorded retries are
+        exchanges of their own.
+        :param client: Pushwoosh or IntegrationAPI instance
+        :param paced: keep recorded intervals between requests (scaled by speed)
+        :return: number of requests sent
+        """
+        send = client._send_request
+        retry_with = getattr(send, "retry_with", None)
+        if retry_with is not None:
+            send = functools.partial(retry_with(stop=stop_after_attempt(1), reraise=True), client)
+
+        started = time.monotonic()
+        count = 0
+        for exchange in self.exchanges:
+            if paced and self.speed:
+                wait = exchange["offset"] / self.speed - (time.monotonic() - started)
+                if wait > 0:
+                    time.sleep(wait)
+
+            body = json.loads(exchange["request"]) if exchange["request"] else {}
+            if isinstance(body, dict) and isinstance(body.get("request"), dict):
+                body = body["request"]
+            try:
+                send(uri=exchange["uri"], request=body)
+            except PushwooshException as e:
+                logger.debug("Replayed request to {} raised {}".format(exchange["uri"], e))
+            count += 1
+        return count
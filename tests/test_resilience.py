@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+
+from pushwoosh_api import CircuitBreaker, Resilience, CircuitOpenError
+
+
+class FakeResponse:
+
+    def __init__(self, name, status_code=200):
+        self.name = name
+        self.status_code = status_code
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_transitions(self):
+        transitions = []
+        breaker = CircuitBreaker("getResults", failure_threshold=0.5, window_size=4, minimum_calls=4,
+                                 reset_timeout=0.05, on_state_change=lambda *args: transitions.append(args))
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, "half_open")
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+        self.assertTrue(breaker.allow())
+
+        self.assertEqual(transitions, [
+            ("getResults", "closed", "open"),
+            ("getResults", "open", "half_open"),
+            ("getResults", "half_open", "open"),
+            ("getResults", "open", "half_open"),
+            ("getResults", "half_open", "closed"),
+        ])
+
+    def test_open_circuit_fails_fast(self):
+        resilience = Resilience(minimum_calls=2, window_size=2, reset_timeout=60)
+        calls = []
+
+        def send():
+            calls.append(1)
+            return FakeResponse("error", 503)
+
+        for _ in range(2):
+            self.assertEqual(resilience.call("createMessage", send).status_code, 503)
+        with self.assertRaises(CircuitOpenError):
+            resilience.call("createMessage", send)
+        self.assertEqual(len(calls), 2)
+
+
+class HedgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hedges = []
+        self.resilience = Resilience(hedge_delay=0.05, max_workers=1,
+                                     on_hedge=lambda uri, delay: self.hedges.append((uri, delay)))
+
+    def tearDown(self):
+        self.resilience.shutdown()
+
+    def test_hedge_wins(self):
+        responses = [FakeResponse("slow"), FakeResponse("fast")]
+        attempts = iter([(0.5, responses[0]), (0.0, responses[1])])
+        lock = threading.Lock()
+
+        def send():
+            with lock:
+                delay, response = next(attempts)
+            time.sleep(delay)
+            return response
+
+        started = time.monotonic()
+        response = self.resilience.call("getResults", send)
+        self.assertIs(response, responses[1])
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertEqual(self.hedges, [("getResults", 0.05)])
+        self.assertTrue(responses[0].closed.wait(1))
+        self.assertFalse(responses[1].closed.is_set())
+
+    def test_no_hedge_for_fast_or_non_idempotent_calls(self):
+        self.assertEqual(self.resilience.call("getResults", lambda: FakeResponse("fast")).name, "fast")
+        self.assertEqual(self.resilience.call("createMessage", lambda: time.sleep(0.1) or FakeResponse("slow")).name,
+                         "slow")
+        self.assertEqual(self.resilience.call("getResults", lambda: time.sleep(0.1) or FakeResponse("stream"),
+                                              hedge=False).name, "stream")
+        self.assertEqual(self.hedges, [])
+
+    def test_first_attempts_are_not_bounded_by_pool(self):
+        resilience = Resilience(hedge_delay=1.0, max_workers=1)
+        results = []
+
+        def call():
+            results.append(resilience.call("getResults", lambda: time.sleep(0.2) or FakeResponse("ok")))
+
+        threads = [threading.Thread(target=call) for _ in range(6)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual(len(results), 6)
+        resilience.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+
+from pushwoosh_api import SegmentIndex, parse_filter, FilterSyntaxError
+from pushwoosh_api.segmentation import _Bitmap, _union, _iter_bits, _DENSE_THRESHOLD
+
+
+class ParseFilterTest(unittest.TestCase):
+
+    def test_precedence(self):
+        self.assertEqual(parse_filter('A("a") + A("b") * A("c")'),
+                         ("or", ("app", "a", None), ("and", ("app", "b", None), ("app", "c", None))))
+        self.assertEqual(parse_filter('(A("a") + A("b")) * A("c")'),
+                         ("and", ("or", ("app", "a", None), ("app", "b", None)), ("app", "c", None)))
+        self.assertEqual(parse_filter('A("a") + A("b") \\ A("c")'),
+                         ("or", ("app", "a", None), ("diff", ("app", "b", None), ("app", "c", None))))
+        self.assertEqual(parse_filter('NOT A("a") AND A("b") OR A("c")'),
+                         ("or", ("and", ("not", ("app", "a", None)), ("app", "b", None)), ("app", "c", None)))
+
+    def test_arguments(self):
+        self.assertEqual(parse_filter('A("a", ["iOS", "Android"])'), ("app", "a", ["iOS", "Android"]))
+        self.assertEqual(parse_filter('AT("a", "Age", BETWEEN, [18, 30.5])'),
+                         ("tag", "a", "Age", "BETWEEN", [18, 30.5]))
+        self.assertEqual(parse_filter("T('Name', EQ, 'O\\'Brien')"), ("tag", None, "Name", "EQ", "O'Brien"))
+        self.assertEqual(parse_filter('T("Flag", notset)'), ("tag", None, "Flag", "NOTSET", None))
+
+    def test_syntax_errors(self):
+        for expression in ['A("a") +', 'A("a"', 'A("a") A("b")', 'B("a")', 'T("x", LIKE, 1)', 'T("x", EQ)',
+                           'T("x", EQ, [1])', 'T("x", IN, 1)', 'T("x", BETWEEN, [1])', 'T("x", ANY, 1)',
+                           'A(1)', 'A("a") & A("b")', '']:
+            with self.assertRaises(FilterSyntaxError, msg=expression):
+                parse_filter(expression)
+
+    def test_error_position(self):
+        with self.assertRaises(FilterSyntaxError) as context:
+            parse_filter('A("a") * B("b")')
+        self.assertEqual(context.exception.position, 9)
+
+
+class BitmapTest(unittest.TestCase):
+
+    def test_sparse_and_dense_blocks(self):
+        positions = set(range(0, 3 * _DENSE_THRESHOLD, 2)) | {70000, 65535, 65536, 200001}
+        bitmap = _Bitmap()
+        for position in sorted(positions, reverse=True):
+            bitmap.add(position)
+        bitmap.add(70000)
+        self.assertIsInstance(bitmap.blocks[0], bytearray)
+        self.assertNotIsInstance(bitmap.blocks[1], bytearray)
+        self.assertEqual(list(_iter_bits(_union([bitmap, None], 200002))), sorted(positions))
+
+    def test_union(self):
+        first, second = _Bitmap(), _Bitmap()
+        for position in range(0, 100000, 3):
+            first.add(position)
+        for position in range(0, 100000, 5):
+            second.add(position)
+        expected = {p for p in range(100000) if p % 3 == 0 or p % 5 == 0}
+        self.assertEqual(set(_iter_bits(_union([first, second], 100000))), expected)
+        self.assertEqual(_union([], 100000), 0)
+
+
+class SegmentIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SegmentIndex()
+        self.index.load_devices([
+            {"hwid": "d0", "application": "app1", "platform": "iOS",
+             "tags": {"Age": 17, "Language": "en", "Interests": ["music", "sport"]}},
+            {"hwid": "d1", "application": "app1", "platform": "Android",
+             "tags": {"Age": "25", "Language": "de", "Interests": ["sport"]}},
+            {"hwid": "d2", "application": "app2", "platform": "iOS", "tags": {"Age": 40.5, "Language": "fr"}},
+            {"hwid": "d3", "application": "app2", "platform": "Android", "tags": {"Age": "n/a"}},
+            {"hwid": "d4", "application": "app2", "platform": "iOS", "tags": {"Premium": True}},
+        ])
+
+    def devices(self, devices_filter):
+        return list(self.index.devices(devices_filter))
+
+    def test_applications(self):
+        self.assertEqual(self.devices('A("app1")'), ["d0", "d1"])
+        self.assertEqual(self.devices('A("app2", ["iOS"])'), ["d2", "d4"])
+        self.assertEqual(self.devices('A("unknown")'), [])
+
+    def test_operators(self):
+        self.assertEqual(self.devices('T("Language", EQ, "de")'), ["d1"])
+        self.assertEqual(self.devices('T("Language", IN, ["de", "fr"])'), ["d1", "d2"])
+        self.assertEqual(self.devices('T("Age", ANY)'), ["d0", "d1", "d2", "d3"])
+        self.assertEqual(self.devices('T("Premium", EQ, true)'), ["d4"])
+        self.assertEqual(self.devices('T("Premium", EQ, "true")'), ["d4"])
+        self.assertEqual(self.devices('AT("app2", "Language", ANY)'), ["d2"])
+
+    def test_negations_cover_whole_snapshot(self):
+        self.assertEqual(self.devices('T("Language", NOTEQ, "de")'), ["d0", "d2", "d3", "d4"])
+        self.assertEqual(self.devices('T("Language", NOTIN, ["de", "fr"])'), ["d0", "d3", "d4"])
+        self.assertEqual(self.devices('T("Language", NOTSET)'), ["d3", "d4"])
+        self.assertEqual(self.devices('T("Missing", NOTSET)'), ["d0", "d1", "d2", "d3", "d4"])
+        self.assertEqual(self.devices('NOT A("app1")'), ["d2", "d3", "d4"])
+
+    def test_numbers_and_strings(self):
+        self.assertEqual(self.devices('T("Age", GTE, 18)'), ["d1", "d2"])
+        self.assertEqual(self.devices('T("Age", LTE, "25")'), ["d0", "d1"])
+        self.assertEqual(self.devices('T("Age", BETWEEN, [17, 40])'), ["d0", "d1"])
+        self.assertEqual(self.devices('T("Age", EQ, 25.0)'), ["d1"])
+        self.assertEqual(self.devices('T("Age", GTE, "a")'), ["d3"])
+        self.assertEqual(self.devices('T("Age", BETWEEN, [1, "z"])'), [])
+
+    def test_list_tags(self):
+        self.assertEqual(self.devices('T("Interests", EQ, "sport")'), ["d0", "d1"])
+        self.assertEqual(self.devices('T("Interests", IN, ["music", "art"])'), ["d0"])
+        self.assertEqual(self.devices('T("Interests", NOTEQ, "music")'), ["d1", "d2", "d3", "d4"])
+
+    def test_combinations(self):
+        self.assertEqual(self.devices('A("app1") + A("app2") * T("Language", ANY)'), ["d0", "d1", "d2"])
+        self.assertEqual(self.devices('(A("app1") + A("app2")) \\ T("Age", GTE, 18)'), ["d0", "d3", "d4"])
+        self.assertEqual(self.index.count('A("app2") \\ T("Premium", ANY) \\ T("Language", EQ, "fr")'), 1)
+
+    def test_merge_and_growth(self):
+        compiled = self.index.compile('T("Language", EQ, "de")')
+        self.assertEqual(self.index.add_device("d0", "app3", {"Language": "de"}), 0)
+        self.index.add_device("d5", "app3", {"Language": "de"})
+        self.assertEqual(self.devices('T("Language", EQ, "de")'), ["d0", "d1", "d5"])
+        self.assertEqual(bin(compiled()).count("1"), 3)
+        self.assertEqual(self.devices('A("app3")'), ["d0", "d5"])
+        self.assertEqual(len(self.index), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import date, datetime, timedelta, timezone
+
+from pushwoosh_api import Pushwoosh, TrackingLogDownloader, ReplayResponse, iter_json_array, EmptyJsonResponse, \
+    HttpError
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    document = json.dumps({
+        "status_code": 200,
+        "status_message": "O[K\"]",
+        "response": {
+            "rows": [{"a": 1, "s": "é[]\"x", "n": [1, 2.5, {"z": None}]}, 12.5, 1.5e3, -7, True, None, "tail"]
+        }
+    }, ensure_ascii=False).encode("utf-8")
+
+    def test_split_at_every_offset(self):
+        expected = json.loads(self.document)["response"]["rows"]
+        for offset in range(len(self.document) + 1):
+            chunks = [self.document[:offset], self.document[offset:]]
+            self.assertEqual(list(iter_json_array(chunks)), expected, "split at {}".format(offset))
+
+    def test_small_chunks(self):
+        expected = json.loads(self.document)["response"]["rows"]
+        for size in [1, 2, 3, 7]:
+            chunks = [self.document[i:i + size] for i in range(0, len(self.document), size)]
+            self.assertEqual(list(iter_json_array(chunks)), expected, "chunk size {}".format(size))
+
+    def test_number_at_chunk_boundary(self):
+        self.assertEqual(list(iter_json_array([b'{"r":[{"a":1}, 12.', b'5, 3]}'])), [{"a": 1}, 12.5, 3])
+
+    def test_no_array(self):
+        with self.assertRaises(EmptyJsonResponse):
+            list(iter_json_array([b'{"status_code": 210, "status_message": "Error"}']))
+        with self.assertRaises(EmptyJsonResponse):
+            list(iter_json_array([b"<html>Bad gateway</html>"]))
+
+    def test_unterminated_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"rows": [{"a": 1}, {"b": 2}']))
+
+    def test_prefix(self):
+        prefixes = []
+        list(iter_json_array([b'{"status_code": 200, "response": {"rows": []}}'], on_prefix=prefixes.append))
+        self.assertEqual(prefixes, ['{"status_code": 200, "response": {"rows": '])
+
+    def test_prefix_without_array(self):
+        prefixes = []
+        with self.assertRaises(EmptyJsonResponse):
+            list(iter_json_array([b'{"status_code": 210, ', b'"status_message": "bad date"}'],
+                                 on_prefix=prefixes.append))
+        self.assertEqual(prefixes, ['{"status_code": 210, "status_message": "bad date"}'])
+
+    def test_suffix(self):
+        suffixes = []
+        rows = list(iter_json_array([b'{"response": [1, 2], "status_code": ', b'210}'], on_suffix=suffixes.append))
+        self.assertEqual(rows, [1, 2])
+        self.assertEqual(suffixes, [', "status_code": 210}'])
+
+    def test_key(self):
+        document = b'{"errors": ["response"], "status_code": 200, "response": {"rows": [{"a": "[]"}, 2]}}'
+        self.assertEqual(list(iter_json_array([document])), ["response"])
+        for offset in range(len(document) + 1):
+            chunks = [document[:offset], document[offset:]]
+            self.assertEqual(list(iter_json_array(chunks, key="response")), [{"a": "[]"}, 2],
+                             "split at {}".format(offset))
+        with self.assertRaises(EmptyJsonResponse):
+            list(iter_json_array([b'{"errors": [], "status_code": 200}'], key="response"))
+
+
+class FakeTransport:
+    """
+    Serves getTrackingLog responses by date: date -> (HTTP status, body)
+    """
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.dates = []
+
+    def post(self, url, data=None, **kwargs):
+        day = json.loads(data)["request"]["date"]
+        self.dates.append(day)
+        status, body = self.bodies[day]
+        return ReplayResponse({"url": url, "status": status, "body": body})
+
+
+def envelope(events, status_code=200):
+    return json.dumps({"status_code": status_code, "status_message": "OK", "response": {"rows": events}})
+
+
+class TrackingLogGeneratorTest(unittest.TestCase):
+
+    def events(self, status, body):
+        transport = FakeTransport({"2021-01-01": (status, body)})
+        return list(Pushwoosh("https://example.com/json/1.3", "key", transport=transport)
+                    .tracking_log_generator("2021-01-01"))
+
+    def test_events(self):
+        self.assertEqual(self.events(200, envelope([{"e": 1}, {"e": 2}])), [{"e": 1}, {"e": 2}])
+        self.assertEqual(self.events(200, '{"errors": [], "response": [{"e": 1}]}'), [{"e": 1}])
+
+    def test_status_errors(self):
+        for status, body in [(200, '{"status_code": 210, "status_message": "bad date"}'),
+                             (200, '{"status_code": 210, "response": []}'),
+                             (200, '{"response": [{"e": 1}], "status_code": 210}'),
+                             (500, "Internal error")]:
+            with self.assertRaises(HttpError, msg=body):
+                self.events(status, body)
+
+    def test_not_json(self):
+        with self.assertRaises(EmptyJsonResponse):
+            self.events(200, "<html>Bad gateway</html>")
+
+
+class TrackingLogDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.transport = FakeTransport({
+            "2021-01-01": (200, envelope([{"e": 1}, {"e": 2}])),
+            "2021-01-02": (200, '{"status_code": 210, "status_message": "bad date"}'),
+            "2021-01-03": (200, envelope([])),
+        })
+        self.downloader = TrackingLogDownloader(Pushwoosh("https://example.com/json/1.3", "key",
+                                                          transport=self.transport),
+                                                directory=self.directory, max_workers=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_download(self):
+        with self.assertRaises(HttpError):
+            self.downloader.download(date(2021, 1, 1), date(2021, 1, 3))
+        # days not started yet when a day fails are cancelled, so 2021-01-03 may be missing
+        files = os.listdir(self.directory)
+        self.assertIn("2021-01-01.jsonl", files)
+        self.assertFalse([name for name in files if name.startswith("2021-01-02") or name.endswith(".part")])
+        with open(self.downloader.path(date(2021, 1, 1))) as f:
+            self.assertEqual([json.loads(line) for line in f], [{"e": 1}, {"e": 2}])
+
+        self.transport.bodies["2021-01-02"] = (200, envelope([{"e": 3}]))
+        self.transport.dates = []
+        self.assertEqual(self.downloader.download(date(2021, 1, 1), date(2021, 1, 3))[date(2021, 1, 2)], 1)
+        self.assertNotIn("2021-01-01", self.transport.dates)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["2021-01-01.jsonl", "2021-01-02.jsonl", "2021-01-03.jsonl"])
+
+    def test_open_days_skipped(self):
+        today = datetime.now(timezone.utc).date()
+        yesterday = today - timedelta(days=1)
+        for day in [yesterday, today, today + timedelta(days=1)]:
+            self.transport.bodies[day.isoformat()] = (200, envelope([]))
+        self.assertEqual(self.downloader.download(yesterday, today + timedelta(days=1)), {yesterday: 0})
+        self.assertEqual(self.transport.dates, [yesterday.isoformat()])
+
+    def test_events(self):
+        events = sorted(self.downloader.events(date(2021, 1, 1), date(2021, 1, 1)), key=lambda item: item[1]["e"])
+        self.assertEqual(events, [(date(2021, 1, 1), {"e": 1}), (date(2021, 1, 1), {"e": 2})])
+
+    def test_events_error(self):
+        self.transport.bodies["2021-01-01"] = (200, '{"status_code": 200, "response": [{"e": 1}, {"e": 2}, {"e"')
+        received = []
+        with self.assertRaises(ValueError):
+            for day, event in self.downloader.events(date(2021, 1, 1), date(2021, 1, 1)):
+                received.append(event)
+        self.assertEqual(received, [{"e": 1}, {"e": 2}])
+        with self.assertRaises(HttpError):
+            list(self.downloader.events(date(2021, 1, 2), date(2021, 1, 3)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pushwoosh_api import Pushwoosh, RecordingTransport, ReplayTransport, ReplayResponse, load_cassette
+
+ENDPOINT = "https://example.com/json/1.3"
+
+
+class FakeTransport:
+    """
+    Returns prepared responses in order
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def post(self, url, data=None, **kwargs):
+        return self.responses.pop(0)
+
+
+class StreamOnlyResponse:
+    """
+    Successful response which body can only be read in chunks
+    """
+    status_code = 200
+    reason = "OK"
+    ok = True
+
+    def __init__(self, body):
+        self.headers = {"Content-Type": "application/json"}
+        self.body = body.encode("utf-8")
+        self.closed = False
+
+    @property
+    def text(self):
+        raise AssertionError("streamed response body was read at once")
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for i in range(0, len(self.body), 4):
+            yield self.body[i:i + 4]
+
+    def close(self):
+        self.closed = True
+
+
+def response(status, body):
+    return ReplayResponse({"url": ENDPOINT, "status": status, "body": body})
+
+
+class RecordReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "traffic.jsonl.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_retried_request_replayed_once(self):
+        fake = FakeTransport([response(500, "Internal error"), response(200, '{"status_code": 200, "response": 1}')])
+        with RecordingTransport(self.path, transport=fake) as recording:
+            result = Pushwoosh(ENDPOINT, "secret", transport=recording).list_filters()
+        self.assertEqual(result["response"], 1)
+
+        exchanges = load_cassette(self.path)
+        self.assertEqual([exchange["status"] for exchange in exchanges], [500, 200])
+        self.assertNotIn("secret", exchanges[0]["request"])
+
+        replay = ReplayTransport(self.path, speed=None)
+        served = []
+        post = replay.post
+
+        def spy(url, data=None, **kwargs):
+            served.append(None)
+            replayed = post(url, data=data, **kwargs)
+            served[-1] = replayed.status_code
+            return replayed
+
+        replay.post = spy
+        self.assertEqual(replay.run(Pushwoosh(ENDPOINT, transport=replay)), 2)
+        self.assertEqual(served, [500, 200])
+
+    def test_streamed_response_recorded_while_read(self):
+        body = json.dumps({"status_code": 200, "response": {"rows": [{"e": "é"}, {"e": 2}]}}, ensure_ascii=False)
+        streamed = StreamOnlyResponse(body)
+        with RecordingTransport(self.path, transport=FakeTransport([streamed])) as recording:
+            events = list(Pushwoosh(ENDPOINT, "secret", transport=recording).tracking_log_generator("2021-01-01"))
+        self.assertEqual(events, [{"e": "é"}, {"e": 2}])
+        self.assertTrue(streamed.closed)
+
+        exchanges = load_cassette(self.path)
+        self.assertEqual(len(exchanges), 1)
+        self.assertEqual(exchanges[0]["body"], body)
+
+        replay = ReplayTransport(self.path, speed=None)
+        self.assertEqual(list(Pushwoosh(ENDPOINT, transport=replay).tracking_log_generator("2021-01-01")), events)
+
+
+if __name__ == "__main__":
+    unittest.main()